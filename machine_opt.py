@@ -1,8 +1,13 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from functools import cached_property
+import math
+import os
 import numpy as np
-import numpy.ma as ma
 from numerics import bisect, clamp
 
+HALF_PI = np.pi / 2
+
 @dataclass
 class Material:
     # N/mm^2 (same as MPa)
@@ -35,7 +40,19 @@ class Tool:
 
 
 def chip_thining_factor(woc, tool_diameter):
-    return np.sqrt(1 - (2*woc / tool_diameter)**2)
+    # Scalars skip the ufunc machinery, arrays (like a search axis)
+    # get evaluated elementwise
+    if isinstance(woc, np.ndarray):
+        return np.sqrt(1 - (2*woc / tool_diameter)**2)
+    # Past half the diameter this is undefined, match np.sqrt's nan
+    # instead of letting math.sqrt raise
+    x = 1 - (2*woc / tool_diameter)**2
+    return math.sqrt(x) if x >= 0 else math.nan
+
+# Average number of flutes in the cut for a given radial doc
+def engaged_flutes(woc, tool_diameter, number_of_flutes):
+    angle = np.arcsin((2 * woc - tool_diameter) / tool_diameter) + HALF_PI
+    return number_of_flutes * angle / (2 * np.pi)
 
 
 @dataclass
@@ -52,23 +69,31 @@ class OptimizerSettings:
     max_spindle_power: float
     max_cutting_force: float
 
+    # The search axes are plain 1D arrays, the optimizer combines
+    # them into an (axial, radial, feed) grid when it needs one.
+    # They're built once here rather than on every access, and in
+    # float32 since nothing here needs more precision than that and it
+    # halves the size of every grid built from them.
+    _axial_doc: np.ndarray = field(init=False, repr=False, compare=False)
+    _radial_doc: np.ndarray = field(init=False, repr=False, compare=False)
+    _feed_per_tooth: np.ndarray = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._axial_doc = np.linspace(self.min_axial_doc, self.max_axial_doc, 100, dtype=np.float32)
+        self._radial_doc = np.linspace(self.min_radial_doc, self.max_radial_doc, 100, dtype=np.float32)
+        self._feed_per_tooth = np.linspace(self.min_feed_per_tooth, self.max_feed_per_tooth, 100, dtype=np.float32)
+
     @property
     def axial_doc(self):
-        range = self.max_axial_doc - self.min_axial_doc
-        range = np.arange(self.min_axial_doc, self.max_axial_doc, range / 100)
-        return range[:, None, None]
+        return self._axial_doc
 
     @property
     def radial_doc(self):
-        range = self.max_radial_doc - self.min_radial_doc
-        range = np.arange(self.min_radial_doc, self.max_radial_doc, range / 100)
-        return range[None, :, None]
+        return self._radial_doc
 
     @property
     def feed_per_tooth(self):
-        range = self.max_feed_per_tooth - self.min_feed_per_tooth
-        range = np.arange(self.min_feed_per_tooth, self.max_feed_per_tooth, range / 100)
-        return range[None, None, :]
+        return self._feed_per_tooth
 
 @dataclass
 class Recipe:
@@ -86,20 +111,26 @@ class Recipe:
     # mm
     axial_doc: np.ndarray
 
+    # The derived values below are cached, so treat a Recipe as
+    # immutable once it's been built
+
     # mm/min
-    @property
+    @cached_property
     def feed_rate(self) -> np.ndarray:
         return self.feed_per_tooth * self.rpm * self.tool.number_of_flutes
 
     # 1/min
-    @property
+    @cached_property
     def rpm(self) -> float:
-        return 1000 * self.surface_speed /( np.pi * self.tool.tool_diameter)
+        return float(1000 * self.surface_speed / (np.pi * self.tool.tool_diameter))
 
     # cm^3/min
-    @property
+    @cached_property
     def mrr(self) -> np.ndarray:
-        return self.feed_rate * self.axial_doc * self.radial_doc / 1000
+        # Fold the scalar factors together first so only the last
+        # multiply is over the full grid
+        k = self.rpm * self.tool.number_of_flutes / 1000
+        return k * self.feed_per_tooth * self.axial_doc * self.radial_doc
 
     @property
     def chip_thining_factor(self) -> np.ndarray:
@@ -107,7 +138,7 @@ class Recipe:
 
     # mm^2
     # This *does* account for chip thining
-    @property
+    @cached_property
     def chip_cross_sectional_area(self) -> np.ndarray:
         return self.axial_doc * self.feed_per_tooth
 
@@ -116,42 +147,119 @@ class Recipe:
     def doc_ratio(self):
         return self.radial_doc / self.axial_doc
 
+# Scores a slab of axial rows and returns its best (mrr, flat index)
+def _best_rows(mrr_j, max_area_j, area):
+    # mrr is an outer product of a radial and an (axial, feed) factor,
+    # einsum builds it in one pass. Feed is the last (fastest varying)
+    # axis so the argmax below walks the C-contiguous score linearly.
+    score = np.einsum('j,ik->ijk', mrr_j, area)
+    np.copyto(score, -np.inf, where=area[:, None, :] > max_area_j[None, :, None])
+    score = score.reshape(-1)
+    flat = int(np.argmax(score))
+    return score[flat], flat
+
+# Smallest slab worth handing out to a thread
+_PARALLEL_MIN_CELLS = 1 << 16
+
+# CPUs this process may actually run on, which under affinity masks or
+# container limits can be fewer than os.cpu_count()
+def _available_cpus():
+    if hasattr(os, "process_cpu_count"):
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+# Finds the (axial, radial, feed) index of the highest mrr recipe
+# whose cutting force stays under max_force, along with that recipe's
+# mrr and cutting force. This is the same math as
+# Optimizer.score but everything that only depends on one or two axes
+# is worked out on those axes first, so the only full size grid is
+# the score itself. Large grids are split into slabs of axial rows
+# that are scored on separate threads (NumPy releases the GIL in
+# these loops) and the per-slab winners are reduced at the end.
+def _best(adoc, rdoc, fpt, dia, flutes, sigma, wear, rpm, max_force, workers=None):
+    mrr_k = rpm * flutes / 1000
+    # (radial,) engaged flutes with the force constants folded in
+    eng = engaged_flutes(rdoc, dia, flutes)
+    force_j = sigma * wear * eng
+    mrr_j = mrr_k * rdoc
+    # (axial, feed) chip cross sectional area
+    area = adoc[:, None] * fpt[None, :]
+    # Force is force_j * area, so rather than building a force grid the
+    # limit is turned into a largest allowed area per radial sample
+    with np.errstate(divide='ignore'):
+        max_area_j = max_force / force_j
+
+    na, nr, nf = len(adoc), len(rdoc), len(fpt)
+    if workers is None:
+        workers = _available_cpus()
+    # Every slab gets at least _PARALLEL_MIN_CELLS cells, so small grids
+    # stay on the calling thread
+    workers = max(1, min(workers, na, na * nr * nf // _PARALLEL_MIN_CELLS))
+    slabs = np.array_split(area, workers)
+    if len(slabs) == 1:
+        results = [_best_rows(mrr_j, max_area_j, area)]
+    else:
+        with ThreadPoolExecutor(len(slabs)) as pool:
+            results = list(pool.map(lambda rows: _best_rows(mrr_j, max_area_j, rows), slabs))
+
+    # Only move past the first slab on a strictly better score so ties
+    # resolve the same way a single argmax would
+    best_val, flat = results[0]
+    offset = 0
+    for rows, (val, local) in zip(slabs, results):
+        if val > best_val:
+            best_val, flat = val, offset + local
+        offset += len(rows) * nr * nf
+
+    # Decode the flat index ourselves, the grid is (axial, radial, feed)
+    i, j, k = flat // (nr * nf), (flat // nf) % nr, flat % nf
+    return i, j, k, best_val, force_j[j] * area[i, k]
+
 @dataclass
 class Optimizer:
     material: Material
     recipe: Recipe
     settings: OptimizerSettings
 
+    # Print the chosen recipe from compute_best/compute_best_nested
+    verbose: bool = False
+
     @property
     def tool(self):
         return self.recipe.tool
 
-    def avg_engaged_flutes(self, recipe=None):
-        dia = self.tool.tool_diameter
-        flutes = self.tool.number_of_flutes
-
-        if recipe is None:
-            recipe = self.recipe
-            print(dia, flutes, recipe.radial_doc)
+    # The search recipe with its 1D axes broadcast against each other.
+    # This and the grid properties below are cached since they're
+    # full grid computations, don't mutate the recipe after using them.
+    @cached_property
+    def grid(self):
+        return replace(
+            self.recipe,
+            axial_doc=self.recipe.axial_doc[:, None, None],
+            radial_doc=self.recipe.radial_doc[None, :, None],
+            feed_per_tooth=self.recipe.feed_per_tooth[None, None, :])
 
-        rdoc = recipe.radial_doc
-        out = flutes * (np.arcsin((2 * rdoc - dia) / dia) + np.arcsin(1)) / 2/ np.pi
-        return out
+    def avg_engaged_flutes(self, recipe=None):
+        rdoc = self.grid.radial_doc if recipe is None else recipe.radial_doc
+        return engaged_flutes(rdoc, self.tool.tool_diameter, self.tool.number_of_flutes)
 
-    @property
+    @cached_property
     def cutting_force(self):
         sigma = self.material.ultimate_tensile_strength
         flutes = self.avg_engaged_flutes()
         wear = self.tool.tool_wear_factor
-        area = self.recipe.chip_cross_sectional_area
+        area = self.grid.chip_cross_sectional_area
         return  sigma * flutes * wear * area
 
-    @property
+    @cached_property
     def score(self):
-        mrr = self.recipe.mrr
+        mrr = self.grid.mrr
         force = self.cutting_force
-        cond = force > self.settings.max_cutting_force
-        return ma.masked_array(mrr, mask=cond)
+        # Recipes over the force limit score -inf so argmax skips them
+        score = np.where(force > self.settings.max_cutting_force, -np.inf, mrr)
+        return np.ascontiguousarray(score)
 
     def print_recipe(self, recipe, force):
         print("axial doc: ", recipe.axial_doc)
@@ -165,18 +273,59 @@ class Optimizer:
         print("number of flutes: ", self.avg_engaged_flutes(recipe))
         print("force: ", force)
 
+    def _search(self, adoc, rdoc, fpt):
+        return _best(
+            adoc,
+            rdoc,
+            fpt,
+            self.tool.tool_diameter,
+            self.tool.number_of_flutes,
+            self.material.ultimate_tensile_strength,
+            self.tool.tool_wear_factor,
+            self.recipe.rpm,
+            self.settings.max_cutting_force)
+
     def compute_best(self):
-        score = self.score
-        idx = np.argmax(score)
-        idx = np.unravel_index(idx, score.shape)
-        adoc_idx = idx[0]
-        rdoc_idx = idx[1]
-        fpt_idx = idx[2]
-        feed_per_tooth = self.recipe.feed_per_tooth[0, 0, fpt_idx]
-        adoc = self.recipe.axial_doc[adoc_idx, 0, 0]
-        rdoc = self.recipe.radial_doc[0, rdoc_idx, 0]
+        adoc_idx, rdoc_idx, fpt_idx, _, force = self._search(
+            self.recipe.axial_doc,
+            self.recipe.radial_doc,
+            self.recipe.feed_per_tooth)
+        feed_per_tooth = self.recipe.feed_per_tooth[fpt_idx]
+        adoc = self.recipe.axial_doc[adoc_idx]
+        rdoc = self.recipe.radial_doc[rdoc_idx]
+        out = Recipe(tool=self.tool, axial_doc=adoc, radial_doc=rdoc, feed_per_tooth=feed_per_tooth, surface_speed=self.recipe.surface_speed)
+        if self.verbose:
+            self.print_recipe(out, force)
+        return out
+
+    # Same search as compute_best but instead of one big grid we search
+    # a small coarse grid, shrink each axis to the cells either side of
+    # the winner and search again. levels=4, coarse=21 is ~37k
+    # evaluations vs 1M for the full grid and ends up at a finer
+    # resolution. Like any zoom search it can miss an optimum that
+    # falls between the coarse samples. coarse is odd so each zoomed
+    # axis resamples the previous winner at its midpoint, and the best
+    # recipe seen at any level is kept in case rounding lets a finer
+    # level come out slightly worse.
+    def compute_best_nested(self, levels=4, coarse=21):
+        bounds = [
+            (axis[0], axis[-1]) for axis in (
+                self.recipe.axial_doc,
+                self.recipe.radial_doc,
+                self.recipe.feed_per_tooth)]
+        best = None
+        for _ in range(levels):
+            axes = [np.linspace(lo, hi, coarse, dtype=np.float32) for lo, hi in bounds]
+            *idx, mrr, force = self._search(*axes)
+            if best is None or mrr > best[0]:
+                best = (mrr, force, [axis[i] for axis, i in zip(axes, idx)])
+            bounds = [
+                (axis[clamp(i - 1, 0, coarse - 1)], axis[clamp(i + 1, 0, coarse - 1)])
+                for axis, i in zip(axes, idx)]
+        _, force, (adoc, rdoc, feed_per_tooth) = best
         out = Recipe(tool=self.tool, axial_doc=adoc, radial_doc=rdoc, feed_per_tooth=feed_per_tooth, surface_speed=self.recipe.surface_speed)
-        self.print_recipe(out, self.cutting_force[idx])
+        if self.verbose:
+            self.print_recipe(out, force)
         return out
 
     @property
@@ -190,25 +339,26 @@ class Optimizer:
 Aluminum6061 = Material(210.0)
 Steel1215 = Material(540.0)
 
-my_tool = Tool(tool_diameter=6.35, number_of_flutes=3)
-
-my_settings = OptimizerSettings(
-    min_axial_doc = 0.5,
-    max_axial_doc = 1.5 * my_tool.tool_diameter,
-    min_radial_doc = 0.2,
-    max_radial_doc = 0.5 * my_tool.tool_diameter,
-    max_feed_per_tooth = 0.1,
-    min_feed_per_tooth = 0.01,
-    min_chip_cross_sectional_area = 0.02,
-    max_spindle_power = 1.5,
-    max_cutting_force = 17.0,)
-
-my_recipe = Recipe(
-    tool = my_tool,
-    axial_doc=my_settings.axial_doc,
-    radial_doc=my_settings.radial_doc,
-    surface_speed=300,
-    feed_per_tooth=my_settings.feed_per_tooth)
-
-my_state = Optimizer(Aluminum6061, my_recipe, my_settings)
-print(my_state.compute_best())
+if __name__ == "__main__":
+    my_tool = Tool(tool_diameter=6.35, number_of_flutes=3)
+
+    my_settings = OptimizerSettings(
+        min_axial_doc = 0.5,
+        max_axial_doc = 1.5 * my_tool.tool_diameter,
+        min_radial_doc = 0.2,
+        max_radial_doc = 0.5 * my_tool.tool_diameter,
+        max_feed_per_tooth = 0.1,
+        min_feed_per_tooth = 0.01,
+        min_chip_cross_sectional_area = 0.02,
+        max_spindle_power = 1.5,
+        max_cutting_force = 17.0,)
+
+    my_recipe = Recipe(
+        tool = my_tool,
+        axial_doc=my_settings.axial_doc,
+        radial_doc=my_settings.radial_doc,
+        surface_speed=300,
+        feed_per_tooth=my_settings.feed_per_tooth)
+
+    my_state = Optimizer(Aluminum6061, my_recipe, my_settings, verbose=True)
+    print(my_state.compute_best())
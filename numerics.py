@@ -1,25 +1,19 @@
 def clamp(x, min_x, max_x):
-    if max_x < x:
-        return max_x
-    if min_x > x:
-        return min_x
-
-    return x
+    return min(max(x, min_x), max_x)
 
 # A simple algorithm that can bisect
-# a function
-def bisect(f, eps=1e-4):
-    x = 0.5
-    while True:
+# a function. f should be negative below
+# the root and non-negative above it
+# somewhere in [lo, hi].
+def bisect(f, lo=0.0, hi=1.0, eps=1e-4):
+    while hi - lo > eps:
+        x = (lo + hi) / 2
         fx = f(x)
         if fx < 0:
-            nx = (x + 1) / 2
+            lo = x
         elif fx >= 0:
-            nx = x / 2
+            hi = x
         else:
             return x
 
-        if abs(nx - x) <= eps:
-            return x
-
-        x = nx
+    return (lo + hi) / 2